@@ -11,23 +11,157 @@ import re
 import sys
 import json
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 
+# Обратные слэши в путях появляются только под Windows; на POSIX
+# заменять их при каждом совпадении — лишний проход по строке
+_NEEDS_SLASH_FIX = os.sep == '\\'
+
+
+def _normalize_src(path: str) -> str:
+    """Приводит путь из разметки к канонической форме: без ./ и с прямыми слэшами."""
+    if _NEEDS_SLASH_FIX or '\\' in path:
+        path = path.replace('\\', '/')
+    return path.lstrip('./')
+
+
+def _read_choice(prompt: str, valid: str) -> str:
+    """
+    Читает один пункт меню. В терминале на POSIX — одно нажатие без Enter
+    (termios/cbreak); иначе (Windows, перенаправленный ввод) — обычный input().
+    valid — строка допустимых символов, например '123'.
+    """
+    try:
+        import termios
+        import tty
+        if not sys.stdin.isatty():
+            raise OSError
+        fd = sys.stdin.fileno()
+        while True:
+            print(prompt, end='', flush=True)
+            old_settings = termios.tcgetattr(fd)
+            try:
+                tty.setcbreak(fd)
+                ch = sys.stdin.read(1)
+            finally:
+                termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+            if ch == '\x03':  # Ctrl+C в cbreak-режиме приходит символом
+                raise KeyboardInterrupt
+            print(ch)
+            if ch in valid:
+                return ch
+            print(f"❌ Неверный выбор! Введите один из: {', '.join(valid)}")
+    except (ImportError, OSError):
+        while True:
+            choice = input(prompt).strip()
+            if choice in valid:
+                return choice
+            print(f"❌ Неверный выбор! Введите один из: {', '.join(valid)}")
+
 
 class ImageOptimizer:
+    # Предкомпилированные паттерны (компилируются один раз при загрузке модуля,
+    # а не при каждом вызове re.sub/re.search)
+    # Жадный [^"\']+ для URL и lookahead (?=\s) вместо перечисления расширений:
+    # исключает катастрофический backtracking на "кривой" разметке и ложные
+    # совпадения вроде <imgx. Расширение проверяется отдельно в Python.
+    # Негативный lookahead отсекает уже обработанные теги (с data-атрибутами)
+    # еще на этапе поиска — без обращений к файловой системе при повторном запуске.
+    # Пропуск корректен только в режимах с data-атрибутами: в режиме «только JSON»
+    # размеченный ранее тег все равно надо пройти, чтобы картинка попала в
+    # images_data.json — для него есть вариант паттерна без lookahead ниже.
+    # Альтернатива url(...) ловит инлайновые стили внутри HTML/PHP, чтобы фоны
+    # обрабатывались тем же единственным проходом регулярки, что и img теги
+    HTML_REF_RE = re.compile(
+        r'<img(?![^>]*data-(?:webp|avif|original)-(?:src|ext)=)(?=\s)(?P<before>[^>]*?)\ssrc\s*=\s*["\'](?P<imgsrc>[^"\']+)["\'](?P<after>[^>]*)>'
+        r'|url\(["\']?(?P<urlpath>[^"\'()]+\.(?:jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']?\)',
+        re.IGNORECASE
+    )
+    # Тот же паттерн без lookahead — для режима «только JSON»
+    HTML_REF_ALL_RE = re.compile(
+        r'<img(?=\s)(?P<before>[^>]*?)\ssrc\s*=\s*["\'](?P<imgsrc>[^"\']+)["\'](?P<after>[^>]*)>'
+        r'|url\(["\']?(?P<urlpath>[^"\'()]+\.(?:jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']?\)',
+        re.IGNORECASE
+    )
+    # Блок img(...) в Pug, включая многострочные (класс [^()] захватывает \n).
+    # Как и в IMG_RE, расширение проверяется отдельно в Python.
+    PUG_IMG_RE = re.compile(
+        r'\bimg\(([^()]*?src\s*=\s*["\']([^"\']+)["\'][^()]*?)\)',
+        re.IGNORECASE
+    )
+    URL_RE = re.compile(
+        r'url\(["\']?([^"\'()]+\.(jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']?\)',
+        re.IGNORECASE
+    )
+
+    # Признак уже обработанного блока: один проход по строке
+    # вместо трех проверок `in` на каждый data-атрибут
+    ALREADY_PROCESSED_RE = re.compile(r'data-(?:webp|avif|original)-src=')
+
+    # Устаревшие data-атрибуты от прошлых запусков в режиме с атрибутами.
+    # Нужен только в режиме «только JSON»: в режимах с атрибутами размеченные
+    # теги отсекает lookahead в HTML_REF_RE и до зачистки дело не доходит
+    DATA_ATTR_RE = re.compile(
+        r'\s+data-(webp|avif|original)-(src|priority|ext)=["\'][^"\']*["\']'
+    )
+
+    # Имя файла с кэшем «чистых» файлов между запусками
+    CLEAN_CACHE_NAME = '.image_optimizer_cache.json'
+
+    # Расширения по типам обработки и поддерживаемые изображения (кроме svg).
+    # frozenset: проверка принадлежности за O(1) вместо прохода по списку
+    HTML_EXTENSIONS = frozenset({'.html', '.htm', '.php'})
+    STYLE_EXTENSIONS = frozenset({'.scss', '.sass', '.css'})
+    IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.bmp', '.tiff'})
+
     def __init__(self):
         # Получаем путь к корневой папке проекта (4 уровня вверх от скрипта)
         # dev/assets/python/libs/optimize_images_paths.py -> BASIC-START-TEMPLATE
         script_path = Path(__file__).resolve()
         self.project_root = script_path.parent.parent.parent.parent.parent
-        
-        # Поддерживаемые расширения изображений (кроме svg)
-        self.image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.bmp', '.tiff'}
-        
+
+        # Папка dev нужна почти в каждом методе — собираем Path один раз,
+        # а не при каждом обращении (плюс строковая форма для f-строк)
+        self._dev_root = self.project_root / 'dev'
+        self._dev_root_str = self._dev_root.as_posix()
+
         # Словарь для хранения информации об изображениях для JSON
         self.images_data = {}
+
+        # Кэши результатов по пути изображения: одна и та же картинка
+        # (логотип, иконка) встречается во многих файлах, а состояние
+        # файловой системы в рамках одного запуска не меняется
+        self._variants_cache: Dict[str, Tuple[Dict[str, Tuple[str, int]], str, str, str]] = {}
+        self._optimal_cache: Dict[str, Dict] = {}
+
+        # Кэш содержимого директорий: {директория: {имя_файла: stat_result}}
+        # Один os.scandir на директорию вместо exists()+stat() на каждый файл.
+        # Ключи — строки: пути в горячем цикле склеиваются f-строками
+        self._dir_index: Dict[str, Dict[str, os.stat_result]] = {}
+
+        # Постоянный кэш «чистых» файлов между запусками:
+        # {путь: [st_mtime_ns, st_size]} — файл с таким отпечатком уже
+        # оптимален, и при повторном запуске его можно не обрабатывать
+        self._clean_cache_path = self.project_root / self.CLEAN_CACHE_NAME
+        self._clean_files: Dict[str, List[int]] = {}
+
+        # Подпись дерева картинок для инвалидации кэша чистых файлов
+        # (считается лениво, один раз за запуск)
+        self._images_mtime_ns: Optional[int] = None
+
+        # Защищает общие кэши при параллельной обработке файлов
+        # (RLock, т.к. поиск вариантов изнутри обращается к кэшу директорий)
+        self._cache_lock = threading.RLock()
         
+        # Подробный вывод по каждому изображению. print на каждый матч
+        # заметно замедляет обработку и перемешивается при параллельной
+        # работе, поэтому по умолчанию выключен (включается OPTIMIZE_VERBOSE=1)
+        self.verbose = os.environ.get('OPTIMIZE_VERBOSE', '') == '1'
+        self._log = print if self.verbose else (lambda *args, **kwargs: None)
+
         # Режим сохранения информации
         self.save_mode = None
         
@@ -35,96 +169,171 @@ class ImageOptimizer:
         self.save_hash_in_attribute = False
 
     def get_image_hash(self, image_path: str) -> str:
-        """Создает хэш для пути изображения."""
-        # Нормализуем путь (убираем ./ и используем прямые слэши)
-        normalized_path = image_path.lstrip('./').replace('\\', '/')
-        # Создаем MD5 хэш от нормализованного пути
-        return hashlib.md5(normalized_path.encode('utf-8')).hexdigest()
-
-    def get_file_size(self, file_path: Path) -> int:
-        """Получает размер файла в байтах."""
-        try:
-            return file_path.stat().st_size if file_path.exists() else float('inf')
-        except:
-            return float('inf')
+        """
+        Создает хэш для пути изображения.
+        Путь должен быть уже нормализован (без ./ и с прямыми слэшами) —
+        обработчики файлов нормализуют его один раз на входе.
+        """
+        normalized_path = image_path
+        # Создаем MD5 хэш от нормализованного пути.
+        # Алгоритм менять нельзя: клиентский JS ищет записи в images_data.json
+        # через CryptoJS.MD5 от того же нормализованного пути.
+        # usedforsecurity=False обходит FIPS-проверки OpenSSL —
+        # хэш здесь просто ключ, а не криптография
+        return hashlib.md5(normalized_path.encode('utf-8'), usedforsecurity=False).hexdigest()
 
-    def find_image_variants(self, image_path: str) -> Dict[str, Tuple[str, int]]:
+    def find_image_variants(self, image_path: str) -> Tuple[Dict[str, Tuple[str, int]], str, str, str]:
         """
         Находит все варианты изображения (original, webp, avif) и их размеры.
-        Возвращает словарь {формат: (путь, размер_в_байтах)}
+        Возвращает (словарь {формат: (путь, размер_в_байтах)}, папка, имя,
+        расширение) — путь разбирается на части один раз, чтобы
+        get_optimal_image_info не парсил его заново.
+        Путь приходит уже нормализованным, кэш на время запуска.
+        """
+        cache_key = image_path
+        with self._cache_lock:
+            cached = self._variants_cache.get(cache_key)
+            if cached is None:
+                cached = self._find_image_variants_uncached(image_path)
+                self._variants_cache[cache_key] = cached
+            return cached
+
+    def _write_text_atomic(self, file_path: Path, content: str):
+        """
+        Атомарно записывает файл: сначала во временный рядом, потом os.replace.
+        Прерывание записи (Ctrl+C, падение CI) не оставит обрезанный файл.
+        """
+        tmp_path = file_path.with_suffix(file_path.suffix + '.tmp')
+        try:
+            tmp_path.write_text(content, encoding='utf-8')
+            os.replace(tmp_path, file_path)
+        except OSError:
+            # Подчищаем временный файл, если замена не удалась
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            raise
+
+    def _scan_dir(self, directory: str) -> Dict[str, os.stat_result]:
         """
+        Читает директорию одним os.scandir и кэширует stat-данные файлов.
+        DirEntry.stat() не требует отдельного syscall на каждый файл.
+        """
+        with self._cache_lock:
+            index = self._dir_index.get(directory)
+            if index is None:
+                index = {}
+                try:
+                    with os.scandir(directory) as it:
+                        for entry in it:
+                            if entry.is_file(follow_symlinks=False):
+                                index[entry.name] = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Директории нет (например, нет папки webp/ или avif/)
+                    pass
+                self._dir_index[directory] = index
+            return index
+
+    def _find_image_variants_uncached(self, image_path: str) -> Tuple[Dict[str, Tuple[str, int]], str, str, str]:
+        """Непосредственный поиск вариантов изображения на диске."""
         variants = {}
-        
-        # Преобразуем относительный путь в абсолютный
-        # Убираем ./ в начале если есть
-        clean_path = image_path.lstrip('./')
-        abs_image_path = self.project_root / 'dev' / clean_path
-        
-        print(f"    🔍 Проверяем: {abs_image_path}")
-        
-        if not abs_image_path.exists():
-            print(f"    ❌ Оригинальное изображение не найдено")
-            return variants
-            
+
+        # Разбираем путь на части один раз: они нужны и здесь,
+        # и в get_optimal_image_info для построения потенциальных путей
+        dir_part, _, filename = image_path.rpartition('/')
+        stem, _, ext = filename.rpartition('.')
+        if not stem:
+            stem, ext = filename, ''
+
+        # Абсолютная папка оригинала как строка: f-строка вместо
+        # PurePath-склейки, ведь путь нужен только как ключ для scandir
+        parent_dir = f'{self._dev_root_str}/{dir_part}' if dir_part else self._dev_root_str
+
+        self._log(f"    🔍 Проверяем: {parent_dir}/{filename}")
+
+        original_stat = self._scan_dir(parent_dir).get(filename)
+
+        if original_stat is None:
+            self._log(f"    ❌ Оригинальное изображение не найдено")
+            return variants, dir_part, stem, ext
+
         # Получаем информацию об оригинальном изображении
-        original_size = self.get_file_size(abs_image_path)
+        original_size = original_stat.st_size
         variants['original'] = (image_path, original_size)
-        print(f"    ✅ Оригинал: {original_size} байт")
-        
+        self._log(f"    ✅ Оригинал: {original_size} байт")
+
         # Ищем webp и avif варианты в соседних папках
-        parent_dir = abs_image_path.parent
-        filename_without_ext = abs_image_path.stem
-        
+        rel_prefix = f'{dir_part}/' if dir_part else ''
         for format_name in ['webp', 'avif']:
-            format_dir = parent_dir / format_name
-            format_file = format_dir / f"{filename_without_ext}.{format_name}"
-            
-            if format_file.exists():
-                # Создаем относительный путь для варианта относительно dev/
-                try:
-                    dev_relative_path = str(format_file.relative_to(self.project_root / 'dev')).replace('\\', '/')
-                    size = self.get_file_size(format_file)
-                    variants[format_name] = (dev_relative_path, size)
-                    print(f"    ✅ {format_name}: {size} байт")
-                except ValueError:
-                    # Если не удается создать относительный путь
-                    print(f"    ❌ Ошибка создания относительного пути для {format_name}")
+            format_dir = f'{parent_dir}/{format_name}'
+            format_stat = self._scan_dir(format_dir).get(f'{stem}.{format_name}')
+
+            if format_stat is not None:
+                # Относительный путь варианта строится из уже известных
+                # частей — без relative_to по абсолютному пути
+                variants[format_name] = (f'{rel_prefix}{format_name}/{stem}.{format_name}', format_stat.st_size)
+                self._log(f"    ✅ {format_name}: {format_stat.st_size} байт")
             else:
-                print(f"    ❌ {format_name} не найден: {format_file}")
-        
-        return variants
+                self._log(f"    ❌ {format_name} не найден: {format_dir}/{stem}.{format_name}")
+
+        return variants, dir_part, stem, ext
 
-    def get_optimal_image_info(self, variants: Dict[str, Tuple[str, int]], image_path: str) -> Dict:
-        """Определяет оптимальный путь и приоритеты для всех форматов."""
+    def get_optimal_image_info(self, variants: Dict[str, Tuple[str, int]], image_path: str,
+                               path_parts: Optional[Tuple[str, str, str]] = None) -> Dict:
+        """
+        Определяет оптимальный путь и приоритеты для всех форматов.
+        path_parts — (папка, имя, расширение) из find_image_variants,
+        чтобы не разбирать путь заново.
+        Путь приходит уже нормализованным, кэш на время запуска.
+        """
+        cache_key = image_path
+        with self._cache_lock:
+            cached = self._optimal_cache.get(cache_key)
+            if cached is None:
+                cached = self._get_optimal_image_info_uncached(variants, image_path, path_parts)
+                self._optimal_cache[cache_key] = cached
+            return cached
+
+    def _get_optimal_image_info_uncached(self, variants: Dict[str, Tuple[str, int]], image_path: str,
+                                         path_parts: Optional[Tuple[str, str, str]] = None) -> Dict:
+        """Непосредственный расчет оптимального пути и приоритетов."""
         if not variants:
             return {}
             
-        # Сортируем по размеру файла (меньше = лучше)
-        sorted_variants = sorted(variants.items(), key=lambda x: x[1][1])
-        
+        # Нужен только самый легкий вариант — min вместо полной сортировки
+        best_format, (best_path, best_size) = min(variants.items(), key=lambda x: x[1][1])
+
         result = {
-            'main_src': sorted_variants[0][1][0],  # Самый легкий вариант
-            'data_attributes': {},
+            'main_src': best_path,  # Самый легкий вариант
+            'attr_fragments': [],  # готовые строки name="value" в порядке вывода
             'json_data': {}
         }
-        
-        print(f"    📊 Самый легкий: {sorted_variants[0][0]} ({sorted_variants[0][1][1]} байт)")
+
+        self._log(f"    📊 Самый легкий: {best_format} ({best_size} байт)")
         
         # Получаем оригинальный путь для создания потенциальных путей
         original_path = variants.get('original', ['', 0])[0]
         if original_path:
-            # Создаем потенциальные пути к webp и avif
-            path_parts = Path(original_path)
-            parent = path_parts.parent
-            stem = path_parts.stem
-            original_ext = path_parts.suffix.lstrip('.')  # Расширение без точки
-            
-            # ИСПРАВЛЕНИЕ: правильно создаем пути, используя прямые слэши
-            potential_webp = str(parent / 'webp' / f'{stem}.webp').replace('\\', '/')
-            potential_avif = str(parent / 'avif' / f'{stem}.avif').replace('\\', '/')
+            # Части пути уже разобраны в find_image_variants;
+            # Path-разбор остается только как запасной вариант
+            if path_parts is not None:
+                dir_part, stem, original_ext = path_parts
+            else:
+                parsed = Path(original_path)
+                dir_part = parsed.parent.as_posix()
+                if dir_part == '.':
+                    dir_part = ''
+                stem = parsed.stem
+                original_ext = parsed.suffix.lstrip('.')  # Расширение без точки
+
+            # Создаем потенциальные пути к webp и avif (пути уже в POSIX-виде)
+            prefix = f'{dir_part}/' if dir_part else ''
+            potential_webp = f'{prefix}webp/{stem}.webp'
+            potential_avif = f'{prefix}avif/{stem}.avif'
             
-            # Добавляем data-original-ext
-            result['data_attributes']['data-original-ext'] = original_ext
+            # Добавляем data-original-ext (всегда идет первым)
+            result['attr_fragments'].append(f'data-original-ext="{original_ext}"')
             
             # Создаем список всех форматов с их информацией
             all_formats = []
@@ -143,35 +352,38 @@ class ImageOptimizer:
                 all_formats.append({
                     'name': 'webp',
                     'path': potential_webp,
-                    'size': float('inf'),  # Максимальный размер для несуществующих
+                    'size': 0,  # Несуществующие отсортируются по флагу exists
                     'exists': False
                 })
-            
+
             if 'avif' not in variants:
                 all_formats.append({
                     'name': 'avif',
                     'path': potential_avif,
-                    'size': float('inf'),  # Максимальный размер для несуществующих
+                    'size': 0,  # Несуществующие отсортируются по флагу exists
                     'exists': False
                 })
-            
+
             # Сортируем форматы: сначала существующие по размеру, потом несуществующие
+            # (флаг exists идет первым в ключе, поэтому сравнения чисто целочисленные)
             all_formats.sort(key=lambda x: (not x['exists'], x['size']))
             
             # Подготавливаем данные для JSON
             json_formats = {}
             
-            # Устанавливаем приоритеты и пути для всех форматов
+            # Устанавливаем приоритеты и пути для всех форматов.
+            # Форматы уже отсортированы, поэтому атрибуты сразу добавляются
+            # в порядке вывода (src, затем priority) — без пересортировки
+            # в обработчиках файлов
             priority = 1
             for format_info in all_formats:
                 format_name = format_info['name']
                 format_path = format_info['path']
-                
-                # Добавляем src атрибут для data-атрибутов
-                result['data_attributes'][f'data-{format_name}-src'] = format_path
-                
-                # Добавляем priority атрибут для data-атрибутов
-                result['data_attributes'][f'data-{format_name}-priority'] = str(priority)
+
+                # Добавляем src и priority атрибуты сразу в готовом виде:
+                # обработчикам остается только подставить свой отступ
+                result['attr_fragments'].append(f'data-{format_name}-src="{format_path}"')
+                result['attr_fragments'].append(f'data-{format_name}-priority="{priority}"')
                 
                 # Добавляем в JSON данные
                 json_formats[format_name] = {
@@ -182,9 +394,9 @@ class ImageOptimizer:
                 }
                 
                 if format_info['exists']:
-                    print(f"    🏆 {format_name}: приоритет {priority} (размер: {format_info['size']} байт)")
+                    self._log(f"    🏆 {format_name}: приоритет {priority} (размер: {format_info['size']} байт)")
                 else:
-                    print(f"    🔮 {format_name}: приоритет {priority} (потенциальный файл)")
+                    self._log(f"    🔮 {format_name}: приоритет {priority} (потенциальный файл)")
                 
                 priority += 1
             
@@ -192,15 +404,19 @@ class ImageOptimizer:
             image_hash = self.get_image_hash(original_path)
             result['json_data'] = {
                 'hash': image_hash,
-                'original_path': original_path.replace('\\', '/'),
+                'original_path': original_path,
                 'original_ext': original_ext,
-                'optimal_src': result['main_src'].replace('\\', '/'),
+                'optimal_src': result['main_src'],
                 'formats': json_formats
             }
             
             # Добавляем в общий словарь изображений
             self.images_data[image_hash] = result['json_data']
-        
+
+        # Замораживаем список атрибутов: результат попадает в кэш и
+        # переиспользуется всеми вхождениями изображения без копирования
+        result['attr_fragments'] = tuple(result['attr_fragments'])
+
         return result
 
     def save_images_json(self):
@@ -208,15 +424,21 @@ class ImageOptimizer:
         if not self.images_data:
             return
         
-        json_path = self.project_root / 'dev' / 'assets' / 'img' / 'images_data.json'
+        json_path = self._dev_root / 'assets' / 'img' / 'images_data.json'
         
         # Создаем директорию если не существует
         json_path.parent.mkdir(parents=True, exist_ok=True)
         
         try:
+            # Файл читает только JS через fetch + JSON.parse, поэтому пишем
+            # компактно (без отступов и пробелов) — файл меньше и парсится
+            # быстрее. Читаемый вид включается через OPTIMIZE_VERBOSE=1
             with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(self.images_data, f, ensure_ascii=False, indent=2)
-            
+                if self.verbose:
+                    json.dump(self.images_data, f, ensure_ascii=False, indent=2)
+                else:
+                    json.dump(self.images_data, f, ensure_ascii=False, separators=(',', ':'))
+
             print(f"\n💾 Сохранен JSON файл: {json_path}")
             print(f"📊 Обработано изображений: {len(self.images_data)}")
             
@@ -234,310 +456,249 @@ class ImageOptimizer:
     def process_html_php_file(self, file_path: Path) -> bool:
         """Обрабатывает HTML/PHP файлы."""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
+            # Быстрая проверка по байтам до декодирования: в большинстве
+            # файлов ни img тегов, ни url() нет, и декодировать UTF-8
+            # с запуском регулярки по ним незачем. Сентинелы сверяем по
+            # приведенной к нижнему регистру копии: регулярки работают
+            # с re.IGNORECASE (<Img, URL(), и префильтр обязан быть
+            # надмножеством их совпадений
+            raw = file_path.read_bytes()
+            low = raw.lower()
+            if b'<img' not in low and b'url(' not in low:
+                return False
+
+            content = raw.decode('utf-8')
             original_content = content
-            
-            # Паттерн для поиска img тегов (включая уже обработанные с data-атрибутами)
-            img_pattern = r'<img([^>]*?)src=["\']([^"\']+\.(jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']([^>]*?)>'
-            
-            def replace_img(match):
-                before_src = match.group(1)
-                image_path = match.group(2)
-                extension = match.group(3)
-                after_src = match.group(4)
-                
-                print(f"  🖼️ Найден img: {image_path}")
-                
-                # Пропускаем SVG
-                if image_path.lower().endswith('.svg'):
-                    return match.group(0)
-                
-                # Проверяем, если тег уже обработан (содержит data-webp-src или data-avif-src)
-                full_tag = match.group(0)
-                if self.should_add_data_attributes() and ('data-webp-src=' in full_tag or 'data-avif-src=' in full_tag or 'data-original-src=' in full_tag):
-                    print(f"  ⚪ Уже обработан, пропускаем")
+
+            def replace_ref(match):
+                # Ветка url(...) — фоны в инлайновых стилях
+                if match.group('urlpath') is not None:
+                    return self._rewrite_url_reference(match, match.group('urlpath'))
+
+                before_src = match.group('before')
+                raw_src = match.group('imgsrc')
+                after_src = match.group('after')
+
+                # Нормализуем путь один раз на входе — хэш, кэши
+                # и поиск вариантов ждут именно эту форму
+                image_path = _normalize_src(raw_src)
+
+                # Проверяем расширение в Python (в регулярке его больше нет),
+                # заодно пропускаем SVG и прочие неподдерживаемые файлы.
+                # splitext + lower только по расширению, а не по всему пути
+                if os.path.splitext(image_path)[1].lower() not in self.IMAGE_EXTENSIONS:
                     return match.group(0)
-                
-                variants = self.find_image_variants(image_path)
+
+                self._log(f"  🖼️ Найден img: {image_path}")
+
+                # В режимах с data-атрибутами уже обработанные теги отсекает
+                # сам HTML_REF_RE через негативный lookahead; в режиме JSON
+                # они проходят сюда намеренно (см. выбор паттерна ниже)
+
+                variants, dir_part, stem, ext = self.find_image_variants(image_path)
                 if not variants:
                     return match.group(0)
-                
-                optimal_info = self.get_optimal_image_info(variants, image_path)
+
+                optimal_info = self.get_optimal_image_info(variants, image_path, (dir_part, stem, ext))
                 if not optimal_info:
                     return match.group(0)
                 
-                # Если режим только JSON, просто заменяем src
+                # Если режим только JSON, просто заменяем src.
+                # Data-атрибуты от прошлых запусков в режиме 1 сносим:
+                # они устарели, а .replace по тегу мог бы переписать
+                # и их значения вместе с src
                 if not self.should_add_data_attributes():
                     new_src = optimal_info['main_src']
-                    new_tag = match.group(0).replace(image_path, new_src)
-                    print(f"  ✅ Заменен src на оптимальный (режим JSON)")
+                    new_tag = self.DATA_ATTR_RE.sub('', match.group(0)).replace(raw_src, new_src)
+                    self._log(f"  ✅ Заменен src на оптимальный (режим JSON)")
                     return new_tag
                 
-                # Удаляем существующие data-атрибуты из before_src и after_src на всякий случай
-                before_src = re.sub(r'\s+data-(webp|avif|original)-(src|priority|ext)=["\'][^"\']*["\']', '', before_src)
-                after_src = re.sub(r'\s+data-(webp|avif|original)-(src|priority|ext)=["\'][^"\']*["\']', '', after_src)
-                
                 # Создаем новый тег с переносами строк и отступами
                 new_src = optimal_info['main_src']
                 
-                # Определяем базовый отступ (количество пробелов перед <img)
-                # Находим начало строки с img тегом
-                lines_before = content[:match.start()].split('\n')
-                current_line = lines_before[-1] if lines_before else ''
+                # Определяем базовый отступ (количество пробелов перед <img):
+                # rfind находит начало строки без копирования префикса файла
+                line_start = content.rfind('\n', 0, match.start()) + 1
+                current_line = content[line_start:match.start()]
                 base_indent = len(current_line) - len(current_line.lstrip()) if current_line.strip() == '' else 0
                 
                 # Добавляем отступ для атрибутов (базовый + 4 пробела)
                 attr_indent = ' ' * (base_indent + 4)
                 
-                # Начинаем новый тег
-                new_tag = f'<img{before_src}src="{new_src}"{after_src}'
-                
+                # Собираем новый тег списком частей + ''.join вместо
+                # конкатенации строк в цикле
+                # (пробел перед src съедается регуляркой)
+                tag_parts = [f'<img{before_src} src="{new_src}"{after_src}']
+
                 # Добавляем data-hash атрибут для связи с JSON (если выбрано)
                 if self.should_save_json() and self.save_hash_in_attribute:
                     image_hash = optimal_info['json_data']['hash']
-                    new_tag += f'\n{attr_indent}data-image-hash="{image_hash}"'
-                
-                # Добавляем data-атрибуты каждый с новой строки в правильном порядке
+                    tag_parts.append(f'\n{attr_indent}data-image-hash="{image_hash}"')
+
+                # Добавляем data-атрибуты каждый с новой строки
+                # (строки уже отрендерены в get_optimal_image_info)
                 if self.should_add_data_attributes():
-                    data_attrs = optimal_info.get('data_attributes', {})
-                    
-                    # Сортируем атрибуты по приоритету: сначала по priority, потом по типу
-                    def sort_attrs(item):
-                        attr_name, attr_value = item
-                        if '-priority' in attr_name:
-                            # Извлекаем приоритет для сортировки
-                            priority = int(attr_value)
-                            return (priority, 1)  # priority атрибуты идут вторыми
-                        elif '-src' in attr_name:
-                            # Для src атрибутов извлекаем приоритет из соответствующего priority атрибута
-                            format_name = attr_name.replace('data-', '').replace('-src', '')
-                            priority_key = f'data-{format_name}-priority'
-                            priority = int(data_attrs.get(priority_key, '999'))
-                            return (priority, 0)  # src атрибуты идут первыми
-                        else:
-                            return (0, 2)  # остальные атрибуты (например, data-original-ext)
-                    
-                    sorted_attrs = sorted(data_attrs.items(), key=sort_attrs)
-                    
-                    for attr_name, attr_value in sorted_attrs:
-                        # Исправляем слэши на прямые
-                        attr_value_fixed = str(attr_value).replace('\\', '/')
-                        new_tag += f'\n{attr_indent}{attr_name}="{attr_value_fixed}"'
-                
-                new_tag += '>'
-                
-                print(f"  ✅ Заменен на многострочный формат")
-                return new_tag
-            
-            content = re.sub(img_pattern, replace_img, content, flags=re.IGNORECASE)
+                    for fragment in optimal_info.get('attr_fragments', ()):
+                        tag_parts.append(f'\n{attr_indent}{fragment}')
+
+                tag_parts.append('>')
+
+                self._log(f"  ✅ Заменен на многострочный формат")
+                return ''.join(tag_parts)
             
+            # В режиме «только JSON» пропускать размеченные теги нельзя:
+            # каждая картинка должна попасть в images_data.json
+            pattern = self.HTML_REF_RE if self.should_add_data_attributes() else self.HTML_REF_ALL_RE
+            content = pattern.sub(replace_ref, content)
+
             if content != original_content:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
+                self._write_text_atomic(file_path, content)
                 return True
-            
+
             return False
-            
+
         except Exception as e:
             print(f"❌ Ошибка при обработке {file_path}: {e}")
             return False
 
+    def _replace_pug_img(self, match) -> str:
+        """Обрабатывает один блок img(...) в Pug (callback для PUG_IMG_RE.sub)."""
+        block = match.group(0)
+        raw_src = match.group(2)
+        # Нормализуем путь один раз на входе (хелперы ждут именно эту форму)
+        image_path = _normalize_src(raw_src)
+
+        # Проверяем расширение в Python (пропускаем SVG и прочие файлы)
+        if os.path.splitext(image_path)[1].lower() not in self.IMAGE_EXTENSIONS:
+            return block
+
+        self._log(f"  🖼️ Найден Pug img: {image_path}")
+
+        # Проверяем, не обработан ли уже блок
+        if self.should_add_data_attributes() and self.ALREADY_PROCESSED_RE.search(block):
+            self._log(f"  ⚪ Уже обработан, пропускаем")
+            return block
+
+        variants, dir_part, stem, ext = self.find_image_variants(image_path)
+        if not variants:
+            return block
+
+        optimal_info = self.get_optimal_image_info(variants, image_path, (dir_part, stem, ext))
+        if not optimal_info:
+            return block
+
+        # Заменяем src на оптимальный во всем блоке
+        new_src = optimal_info['main_src']
+        new_block = block.replace(raw_src, new_src)
+
+        # Если режим только JSON, не добавляем data-атрибуты
+        if not self.should_add_data_attributes() and not self.should_save_json():
+            self._log(f"  ✅ Заменен src на оптимальный (режим без атрибутов)")
+            return new_block
+
+        # Добавляем атрибуты перед закрывающей скобкой
+        attrs_to_add = []
+
+        # Добавляем data-hash атрибут для связи с JSON (если выбрано)
+        if self.should_save_json() and self.save_hash_in_attribute:
+            image_hash = optimal_info['json_data']['hash']
+            attrs_to_add.append(f'data-image-hash="{image_hash}"')
+
+        # Добавляем data-атрибуты (строки уже отрендерены в get_optimal_image_info)
+        if self.should_add_data_attributes():
+            attrs_to_add.extend(optimal_info.get('attr_fragments', ()))
+
+        if attrs_to_add:
+            # Определяем отступ строки, с которой начинается img(
+            subject = match.string
+            line_start = subject.rfind('\n', 0, match.start()) + 1
+            line_prefix = subject[line_start:match.start()]
+            base_indent = len(line_prefix) - len(line_prefix.lstrip())
+            attr_indent = ' ' * (base_indent + 12)  # +12 пробелов для выравнивания атрибутов
+
+            # Убираем закрывающую скобку (последний символ совпадения)
+            block_lines = [new_block[:-1].rstrip()]
+
+            # Добавляем атрибуты с правильными отступами
+            # (пути уже в POSIX-виде, слэши исправлять не нужно)
+            for fragment in attrs_to_add:
+                block_lines.append(f'{attr_indent}{fragment}')
+
+            # Добавляем закрывающую скобку с правильным отступом
+            block_lines.append(f'{attr_indent})')
+            new_block = '\n'.join(block_lines)
+
+        self._log(f"  ✅ Обновлен Pug блок")
+        return new_block
+
     def process_pug_file(self, file_path: Path) -> bool:
-        """Обрабатывает PUG файлы."""
+        """Обрабатывает PUG файлы одним проходом регулярки по всему тексту."""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
+            # Быстрая проверка по байтам до декодирования
+            raw = file_path.read_bytes()
+            if b'img(' not in raw:
+                return False
+
+            content = raw.decode('utf-8')
             original_content = content
-            
-            # Ищем все строки с src="image"
-            lines = content.split('\n')
-            new_lines = []
-            
-            i = 0
-            while i < len(lines):
-                line = lines[i]
-                
-                # Ищем img( в строке
-                if 'img(' in line:
-                    # Ищем src в этой строке или следующих
-                    img_block_lines = [line]
-                    src_match = None
-                    img_block_end_index = i  # Индекс последней строки блока img
-                    
-                    # Проверяем текущую строку на наличие src
-                    src_pattern = r'src=["\']([^"\']+\.(jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']'
-                    src_match = re.search(src_pattern, line, re.IGNORECASE)
-                    
-                    # Если src не найден в текущей строке, ищем в следующих
-                    if not src_match:
-                        j = i + 1
-                        while j < len(lines):
-                            current_line = lines[j]
-                            img_block_lines.append(current_line)
-                            img_block_end_index = j
-                            
-                            src_match = re.search(src_pattern, current_line, re.IGNORECASE)
-                            if src_match:
-                                break
-                            
-                            # Если нашли закрывающую скобку, прерываем поиск
-                            if ')' in current_line:
-                                break
-                                
-                            j += 1
-                    
-                    if src_match:
-                        image_path = src_match.group(1)
-                        print(f"  🖼️ Найден Pug img: {image_path}")
-                        
-                        # Проверяем, не обработан ли уже блок
-                        full_block = '\n'.join(img_block_lines)
-                        if self.should_add_data_attributes() and ('data-webp-src=' in full_block or 'data-avif-src=' in full_block or 'data-original-src=' in full_block):
-                            print(f"  ⚪ Уже обработан, пропускаем")
-                            new_lines.extend(img_block_lines)
-                            i = img_block_end_index + 1
-                            continue
-                        
-                        # Пропускаем SVG
-                        if not image_path.lower().endswith('.svg'):
-                            variants = self.find_image_variants(image_path)
-                            if variants:
-                                optimal_info = self.get_optimal_image_info(variants, image_path)
-                                if optimal_info:
-                                    # Заменяем src на оптимальный
-                                    new_src = optimal_info['main_src']
-                                    
-                                    # Заменяем src во всем блоке
-                                    for k in range(len(img_block_lines)):
-                                        img_block_lines[k] = img_block_lines[k].replace(image_path, new_src)
-                                    
-                                    # Если режим только JSON, не добавляем data-атрибуты
-                                    if not self.should_add_data_attributes() and not self.should_save_json():
-                                        print(f"  ✅ Заменен src на оптимальный (режим без атрибутов)")
-                                        new_lines.extend(img_block_lines)
-                                        i = img_block_end_index + 1
-                                        continue
-                                    
-                                    # Добавляем атрибуты перед закрывающей скобкой
-                                    attrs_to_add = []
-                                    
-                                    # Добавляем data-hash атрибут для связи с JSON (если выбрано)
-                                    if self.should_save_json() and self.save_hash_in_attribute:
-                                        image_hash = optimal_info['json_data']['hash']
-                                        attrs_to_add.append(('data-image-hash', image_hash))
-                                    
-                                    # Добавляем data-атрибуты
-                                    if self.should_add_data_attributes():
-                                        data_attrs = optimal_info.get('data_attributes', {})
-                                        
-                                        # Сортируем атрибуты как в HTML версии
-                                        def sort_attrs(item):
-                                            attr_name, attr_value = item
-                                            if '-priority' in attr_name:
-                                                priority = int(attr_value)
-                                                return (priority, 1)
-                                            elif '-src' in attr_name:
-                                                format_name = attr_name.replace('data-', '').replace('-src', '')
-                                                priority_key = f'data-{format_name}-priority'
-                                                priority = int(data_attrs.get(priority_key, '999'))
-                                                return (priority, 0)
-                                            else:
-                                                return (0, 2)
-                                        
-                                        sorted_attrs = sorted(data_attrs.items(), key=sort_attrs)
-                                        attrs_to_add.extend(sorted_attrs)
-                                    
-                                    if attrs_to_add:
-                                        # Находим строку с закрывающей скобкой
-                                        for k in range(len(img_block_lines)):
-                                            if ')' in img_block_lines[k]:
-                                                # Определяем правильный отступ (такой же как у img строки)
-                                                base_indent = len(img_block_lines[0]) - len(img_block_lines[0].lstrip())
-                                                attr_indent = ' ' * (base_indent + 12)  # +12 пробелов для выравнивания атрибутов
-                                                
-                                                # Убираем скобку из строки
-                                                img_block_lines[k] = img_block_lines[k].replace(')', '').rstrip()
-                                                
-                                                # Добавляем атрибуты с правильными отступами
-                                                attrs_lines = []
-                                                for attr_name, attr_value in attrs_to_add:
-                                                    # Используем прямые слэши для всех путей
-                                                    attr_value_fixed = str(attr_value).replace('\\', '/')
-                                                    attrs_lines.append(f'{attr_indent}{attr_name}="{attr_value_fixed}"')
-                                                
-                                                # Добавляем закрывающую скобку с правильным отступом
-                                                attrs_lines.append(f'{attr_indent})')
-                                                
-                                                # Заменяем последнюю строку блока на строку без скобки
-                                                # и добавляем все атрибуты
-                                                img_block_lines = img_block_lines[:k+1] + attrs_lines
-                                                break
-                                    
-                                    print(f"  ✅ Обновлен Pug блок")
-                    
-                    # Добавляем все строки img блока
-                    new_lines.extend(img_block_lines)
-                    # Перемещаем указатель на следующую строку после блока
-                    i = img_block_end_index + 1
-                else:
-                    # Если это не img строка, просто добавляем её
-                    new_lines.append(line)
-                    i += 1
-            
-            new_content = '\n'.join(new_lines)
-            
+
+            new_content = self.PUG_IMG_RE.sub(self._replace_pug_img, content)
+
             if new_content != original_content:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(new_content)
+                self._write_text_atomic(file_path, new_content)
                 return True
-            
+
             return False
-            
+
         except Exception as e:
             print(f"❌ Ошибка при обработке {file_path}: {e}")
             return False
 
+    def _rewrite_url_reference(self, match, image_path: str) -> str:
+        """Заменяет путь внутри url(...) на оптимальный (общий для CSS и HTML/PHP)."""
+        raw_src = image_path
+        # Нормализуем путь один раз на входе (хелперы ждут именно эту форму)
+        image_path = _normalize_src(raw_src)
+
+        self._log(f"  🖼️ Найден url: {image_path}")
+
+        # Пропускаем SVG (lower только по расширению, а не по всему пути)
+        if os.path.splitext(image_path)[1].lower() == '.svg':
+            return match.group(0)
+
+        variants, dir_part, stem, ext = self.find_image_variants(image_path)
+        if not variants:
+            return match.group(0)
+
+        optimal_info = self.get_optimal_image_info(variants, image_path, (dir_part, stem, ext))
+        if not optimal_info:
+            return match.group(0)
+
+        new_path = optimal_info['main_src']
+        new_url = match.group(0).replace(raw_src, new_path)
+        self._log(f"  ✅ Заменен на: {new_url}")
+        return new_url
+
     def process_scss_css_file(self, file_path: Path) -> bool:
         """Обрабатывает SCSS/CSS файлы."""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
+            # Быстрая проверка по байтам до декодирования.
+            # Нижний регистр, потому что URL_RE работает с re.IGNORECASE
+            # и должен ловить и URL(...)
+            raw = file_path.read_bytes()
+            if b'url(' not in raw.lower():
+                return False
+
+            content = raw.decode('utf-8')
             original_content = content
-            
-            # Паттерн для поиска url() в SCSS/CSS
-            url_pattern = r'url\(["\']?([^"\'()]+\.(jpg|jpeg|png|gif|webp|avif|bmp|tiff))["\']?\)'
-            
-            def replace_url(match):
-                image_path = match.group(1)
-                
-                print(f"  🖼️ Найден SCSS/CSS url: {image_path}")
-                
-                # Пропускаем SVG
-                if image_path.lower().endswith('.svg'):
-                    return match.group(0)
-                
-                variants = self.find_image_variants(image_path)
-                if not variants:
-                    return match.group(0)
-                
-                optimal_info = self.get_optimal_image_info(variants, image_path)
-                if not optimal_info:
-                    return match.group(0)
-                
-                new_path = optimal_info['main_src']
-                new_url = match.group(0).replace(image_path, new_path)
-                print(f"  ✅ Заменен на: {new_url}")
-                return new_url
-            
-            content = re.sub(url_pattern, replace_url, content, flags=re.IGNORECASE)
+
+            content = self.URL_RE.sub(
+                lambda match: self._rewrite_url_reference(match, match.group(1)),
+                content
+            )
             
             if content != original_content:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(content)
+                self._write_text_atomic(file_path, content)
                 return True
             
             return False
@@ -546,20 +707,99 @@ class ImageOptimizer:
             print(f"❌ Ошибка при обработке {file_path}: {e}")
             return False
 
+    def _images_tree_mtime_ns(self) -> int:
+        """
+        Самый свежий mtime в дереве картинок (включая webp/avif копии).
+        Прогон конвертера добавляет или перекодирует варианты — подпись
+        меняется, и кэш чистых файлов сбрасывается. Один stat на файл
+        при старте, дальше значение переиспользуется за весь запуск.
+        """
+        if self._images_mtime_ns is None:
+            latest = 0
+            for root, dirs, names in os.walk(self._dev_root / 'assets' / 'img'):
+                for name in names:
+                    try:
+                        mtime = os.stat(os.path.join(root, name)).st_mtime_ns
+                    except OSError:
+                        continue
+                    if mtime > latest:
+                        latest = mtime
+            self._images_mtime_ns = latest
+        return self._images_mtime_ns
+
+    def _clean_cache_meta(self) -> Dict:
+        """
+        Параметры, при смене которых кэш чистых файлов недействителен.
+        Подпись дерева картинок — признак того, что варианты изображений
+        на диске могли измениться (в том числе в режиме без JSON).
+        """
+        return {
+            'save_mode': self.save_mode,
+            'save_hash_in_attribute': self.save_hash_in_attribute,
+            'images_tree_mtime_ns': self._images_tree_mtime_ns(),
+        }
+
+    def _load_clean_cache(self):
+        """Загружает кэш чистых файлов с прошлого запуска."""
+        self._clean_files = {}
+        try:
+            with open(self._clean_cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('meta') == self._clean_cache_meta():
+                self._clean_files = data.get('files', {})
+        except (OSError, ValueError):
+            # Кэша нет или он поврежден — начинаем с пустого
+            pass
+
+    def _save_clean_cache(self):
+        """Атомарно сохраняет кэш чистых файлов (tmp-файл + os.replace)."""
+        tmp_path = self._clean_cache_path.with_suffix('.json.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'meta': self._clean_cache_meta(), 'files': self._clean_files}, f)
+            os.replace(tmp_path, self._clean_cache_path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить кэш чистых файлов: {e}")
+
     def process_file(self, file_path: Path) -> bool:
         """Обрабатывает файл в зависимости от его типа."""
-        print(f"\n📄 Обрабатываем: {file_path.relative_to(self.project_root / 'dev')}")
-        
+        self._log(f"\n📄 Обрабатываем: {file_path.relative_to(self._dev_root)}")
+
+        # В режиме с JSON кэш чистых файлов не используется: каждая картинка
+        # должна попасть в images_data.json, даже если разметка уже оптимальна
+        use_clean_cache = not self.should_save_json()
+        cache_key = str(file_path)
+        if use_clean_cache:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                st = None
+            if st is not None and self._clean_files.get(cache_key) == [st.st_mtime_ns, st.st_size]:
+                self._log("  ⚡ Не менялся с прошлого запуска, пропускаем")
+                return False
+
         file_extension = file_path.suffix.lower()
-        
-        if file_extension in ['.html', '.htm', '.php']:
-            return self.process_html_php_file(file_path)
+
+        if file_extension in self.HTML_EXTENSIONS:
+            changed = self.process_html_php_file(file_path)
         elif file_extension == '.pug':
-            return self.process_pug_file(file_path)
-        elif file_extension in ['.scss', '.sass', '.css']:
-            return self.process_scss_css_file(file_path)
-        
-        return False
+            changed = self.process_pug_file(file_path)
+        elif file_extension in self.STYLE_EXTENSIONS:
+            changed = self.process_scss_css_file(file_path)
+        else:
+            return False
+
+        # После обработки файл гарантированно актуален — запоминаем его
+        # отпечаток, чтобы при следующем запуске пропустить без регулярок
+        if use_clean_cache:
+            try:
+                st = os.stat(file_path)
+                with self._cache_lock:
+                    self._clean_files[cache_key] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                pass
+
+        return changed
 
     def get_file_type_choice(self) -> List[str]:
         """Показывает меню выбора типов файлов и возвращает список расширений для обработки."""
@@ -574,23 +814,23 @@ class ImageOptimizer:
         
         while True:
             try:
-                choice = input("Выберите режим (1-4): ").strip()
-                
+                choice = _read_choice("Выберите режим (1-4): ", '1234')
+
                 if choice == '1':
                     return ['.pug', '.scss', '.sass', '.html', '.htm', '.php', '.css']
                 elif choice == '2':
                     return ['.pug', '.scss', '.sass']
                 elif choice == '3':
                     return ['.html', '.htm', '.php', '.css']
-                elif choice == '4':
+                else:  # choice == '4'
                     print("\n📝 Введите расширения файлов через запятую (например: html, scss, pug)")
                     print("Доступные расширения: html, htm, php, pug, scss, sass, css")
-                    
+
                     user_input = input("Расширения: ").strip()
                     if not user_input:
                         print("❌ Не введены расширения!")
                         continue
-                    
+
                     # Парсим ввод пользователя
                     extensions = []
                     for ext in user_input.split(','):
@@ -598,22 +838,19 @@ class ImageOptimizer:
                         # Добавляем точку если её нет
                         if not ext.startswith('.'):
                             ext = '.' + ext
-                        
+
                         # Проверяем что расширение поддерживается
                         if ext in ['.html', '.htm', '.php', '.pug', '.scss', '.sass', '.css']:
                             extensions.append(ext)
                         else:
                             print(f"⚠️ Неподдерживаемое расширение: {ext}")
-                    
+
                     if extensions:
                         return extensions
                     else:
                         print("❌ Не найдено поддерживаемых расширений!")
                         continue
-                else:
-                    print("❌ Неверный выбор! Введите 1, 2, 3 или 4")
-                    continue
-                    
+
             except KeyboardInterrupt:
                 print("\n❌ Операция прервана пользователем")
                 sys.exit(0)
@@ -631,23 +868,13 @@ class ImageOptimizer:
         print("   через JavaScript используя хэш пути к изображению")
         print("="*60)
         
-        while True:
-            try:
-                choice = input("Выберите способ сохранения (1-3): ").strip()
-                
-                if choice == '1':
-                    return 'data_attributes'
-                elif choice == '2':
-                    return 'json'
-                elif choice == '3':
-                    return 'both'
-                else:
-                    print("❌ Неверный выбор! Введите 1, 2 или 3")
-                    continue
-                    
-            except KeyboardInterrupt:
-                print("\n❌ Операция прервана пользователем")
-                sys.exit(0)
+        try:
+            choice = _read_choice("Выберите способ сохранения (1-3): ", '123')
+        except KeyboardInterrupt:
+            print("\n❌ Операция прервана пользователем")
+            sys.exit(0)
+
+        return {'1': 'data_attributes', '2': 'json', '3': 'both'}[choice]
 
     def get_hash_attribute_choice(self) -> bool:
         """Показывает меню выбора сохранения хэша в data-image-hash атрибут."""
@@ -673,23 +900,32 @@ class ImageOptimizer:
         print("2. Нет, вычислять хэш в JavaScript по пути")
         print("="*60)
         
-        while True:
-            try:
-                choice = input("Ваш выбор (1-2): ").strip()
-                
-                if choice == '1':
-                    print("✅ Хэш будет сохранен в data-image-hash атрибут")
-                    return True
-                elif choice == '2':
-                    print("✅ Хэш будет вычисляться в JavaScript по пути изображения")
-                    return False
-                else:
-                    print("❌ Неверный выбор! Введите 1 или 2")
-                    continue
-                    
-            except KeyboardInterrupt:
-                print("\n❌ Операция прервана пользователем")
-                sys.exit(0)
+        try:
+            choice = _read_choice("Ваш выбор (1-2): ", '12')
+        except KeyboardInterrupt:
+            print("\n❌ Операция прервана пользователем")
+            sys.exit(0)
+
+        if choice == '1':
+            print("✅ Хэш будет сохранен в data-image-hash атрибут")
+            return True
+        print("✅ Хэш будет вычисляться в JavaScript по пути изображения")
+        return False
+
+    def _iter_source_files(self, selected_extensions: List[str]):
+        """
+        Обходит папку dev одним os.walk и отдает файлы с нужными расширениями.
+        Папка prod отсекается сразу, не спускаясь в нее, а дерево обходится
+        один раз вместо glob на каждое расширение.
+        """
+        wanted_extensions = tuple(selected_extensions)
+
+        for root, dirs, names in os.walk(self._dev_root):
+            if 'prod' in dirs:
+                dirs.remove('prod')
+            for name in names:
+                if name.lower().endswith(wanted_extensions):
+                    yield Path(root) / name
 
     def run(self):
         """Запускает процесс оптимизации."""
@@ -722,15 +958,7 @@ class ImageOptimizer:
                 print("🏷️  Хэш будет вычисляться в JavaScript по пути")
         
         # Находим все файлы для обработки в папке dev
-        dev_folder = self.project_root / 'dev'
-        files_to_process = []
-        
-        for extension in selected_extensions:
-            pattern = f'**/*{extension}'
-            files_to_process.extend(dev_folder.glob(pattern))
-        
-        # Исключаем файлы из папки prod
-        files_to_process = [f for f in files_to_process if 'prod' not in f.parts]
+        files_to_process = list(self._iter_source_files(selected_extensions))
         
         if not files_to_process:
             print("⚠️ Не найдены файлы для обработки")
@@ -739,21 +967,38 @@ class ImageOptimizer:
         print(f"📄 Найдено файлов для обработки: {len(files_to_process)}")
         print("="*60)
         
-        # Очищаем данные изображений перед началом обработки
+        # Очищаем данные изображений и кэши перед началом обработки
+        # (при повторном запуске файлы на диске могли измениться)
         self.images_data = {}
+        self._variants_cache = {}
+        self._optimal_cache = {}
+        self._dir_index = {}
+        self._images_mtime_ns = None
+
+        # Кэш чистых файлов живет между запусками: файлы с совпадающим
+        # отпечатком (mtime_ns + размер) пропускаются без чтения и регулярок
+        self._load_clean_cache()
         
+        # Файлы независимы друг от друга, поэтому обрабатываем их параллельно:
+        # во время чтения/записи и stat-вызовов GIL освобождается
         updated_files = 0
-        for file_path in files_to_process:
-            if self.process_file(file_path):
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(self.process_file, files_to_process))
+
+        for file_path, changed in zip(files_to_process, results):
+            if changed:
                 updated_files += 1
-                print(f"✅ Обновлен: {file_path.relative_to(self.project_root / 'dev')}")
+                print(f"✅ Обновлен: {file_path.relative_to(self._dev_root)}")
             else:
-                print(f"⚪ Без изменений: {file_path.relative_to(self.project_root / 'dev')}")
+                print(f"⚪ Без изменений: {file_path.relative_to(self._dev_root)}")
         
         # Сохраняем JSON файл если нужно
         if self.should_save_json():
             self.save_images_json()
-        
+
+        # Сохраняем кэш чистых файлов для следующего запуска
+        self._save_clean_cache()
+
         print("="*60)
         print(f"✨ Завершено! Обновлено файлов: {updated_files} из {len(files_to_process)}")
         
@@ -776,37 +1021,27 @@ if (imageInfo) {
     console.log('Все форматы:', imageInfo.formats);
 }
             """)
-        
-        # Предлагаем продолжить работу
-        self.show_continue_menu()
 
-    def show_continue_menu(self):
-        """Показывает меню продолжения работы."""
+    def show_continue_menu(self) -> bool:
+        """Показывает меню продолжения работы. Возвращает True для перезапуска."""
         print("\n" + "="*60)
         print("🔄 ЧТО ДЕЛАТЬ ДАЛЬШЕ?")
         print("="*60)
         print("1. Запустить оптимизацию заново")
         print("2. Выйти из программы")
         print("="*60)
-        
-        while True:
-            try:
-                choice = input("Выберите действие (1-2): ").strip()
-                
-                if choice == '1':
-                    print("\n" + "🔄" * 20 + " НОВЫЙ ЗАПУСК " + "🔄" * 20)
-                    self.run()  # Запускаем процесс заново
-                    break
-                elif choice == '2':
-                    print("\n👋 До свидания!")
-                    return
-                else:
-                    print("❌ Неверный выбор! Введите 1 или 2")
-                    continue
-                    
-            except KeyboardInterrupt:
-                print("\n👋 До свидания!")
-                return
+
+        try:
+            choice = _read_choice("Выберите действие (1-2): ", '12')
+        except KeyboardInterrupt:
+            print("\n👋 До свидания!")
+            return False
+
+        if choice == '1':
+            print("\n" + "🔄" * 20 + " НОВЫЙ ЗАПУСК " + "🔄" * 20)
+            return True
+        print("\n👋 До свидания!")
+        return False
 
 
 def main():
@@ -818,7 +1053,10 @@ def main():
         try:
             optimizer = ImageOptimizer()
             optimizer.run()
-            break  # Выходим из цикла после успешного завершения
+            # Перезапуск идет через этот цикл со свежим оптимизатором,
+            # а не рекурсивным self.run() — глубина стека постоянна
+            if not optimizer.show_continue_menu():
+                break
         except KeyboardInterrupt:
             print("\n❌ Операция прервана пользователем")
             break
@@ -833,20 +1071,17 @@ def main():
             print("2. Выйти из программы")
             print("="*60)
             
-            while True:
-                try:
-                    choice = input("Выберите действие (1-2): ").strip()
-                    if choice == '1':
-                        print("\n🔄 Перезапуск программы...")
-                        break
-                    elif choice == '2':
-                        print("\n👋 До свидания!")
-                        sys.exit(1)
-                    else:
-                        print("❌ Неверный выбор! Введите 1 или 2")
-                except KeyboardInterrupt:
-                    print("\n👋 До свидания!")
-                    sys.exit(0)
+            try:
+                choice = _read_choice("Выберите действие (1-2): ", '12')
+            except KeyboardInterrupt:
+                print("\n👋 До свидания!")
+                sys.exit(0)
+
+            if choice == '1':
+                print("\n🔄 Перезапуск программы...")
+            else:
+                print("\n👋 До свидания!")
+                sys.exit(1)
 
 
 if __name__ == "__main__":
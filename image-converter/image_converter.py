@@ -8,6 +8,10 @@
 import os
 import sys
 import argparse
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from PIL import Image
 import pillow_avif  # Для поддержки avif
@@ -21,6 +25,117 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _encode_avif_avifenc(img: Image.Image, output_path: Path, quality: int, speed: int) -> bool:
+    """
+    Кодирует AVIF внешним avifenc (libavif). Обычно заметно быстрее
+    кодировщика из pillow-avif-plugin на тех же настройках качества.
+
+    Args:
+        img: Уже декодированное и нормализованное изображение
+        output_path: Путь к выходному avif файлу
+        quality: Качество сжатия (1-100)
+        speed: Скорость кодировщика (0-10)
+
+    Returns:
+        True если кодирование успешно, False иначе
+    """
+    # avifenc читает файлы, а не пиксели из stdin — отдаем ему
+    # временный PNG (кодирование PNG дешево по сравнению с AVIF)
+    fd, tmp_name = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    try:
+        img.save(tmp_name, 'PNG')
+        try:
+            result = subprocess.run(
+                ['avifenc', '-s', str(speed), '-q', str(quality), tmp_name, str(output_path)],
+                capture_output=True
+            )
+        except OSError as e:
+            # Бинарника нет или его не запустить (например, convert_image
+            # вызвали напрямую, минуя проверку в convert_all) —
+            # возвращаем False, чтобы сработал откат на Pillow
+            logger.warning(f"Не удалось запустить avifenc: {e}")
+            return False
+        if result.returncode != 0:
+            logger.warning(f"avifenc завершился с ошибкой для {output_path.name}: "
+                           f"{result.stderr.decode(errors='replace').strip()}")
+            return False
+        return True
+    finally:
+        os.unlink(tmp_name)
+
+def _convert_one(task: Tuple[Path, List[str], int, int, int, str]) -> int:
+    """
+    Конвертирует одно изображение во все запрошенные форматы.
+    Исходник декодируется один раз, кодируется по разу на формат.
+    Функция на уровне модуля, чтобы задачу можно было отдать
+    в ProcessPoolExecutor (методы класса не сериализуются).
+
+    Args:
+        task: Кортеж (путь к изображению, список форматов, качество,
+              method для webp, speed для avif, кодировщик avif)
+
+    Returns:
+        Количество успешных конвертаций
+    """
+    image_path, output_formats, quality, method, speed, avif_encoder = task
+    successful = 0
+    try:
+        # Инкрементальный режим: копии не старше оригинала не перекодируем.
+        # Если актуальны все форматы, исходник даже не декодируется.
+        # Проверка внутри try: исходник мог исчезнуть после find_images,
+        # и падение stat не должно ронять весь батч в executor.map
+        source_mtime = image_path.stat().st_mtime
+        stale_formats = []
+        for output_format in output_formats:
+            output_path = image_path.parent / output_format / f"{image_path.stem}.{output_format}"
+            if output_path.exists() and output_path.stat().st_mtime >= source_mtime:
+                logger.debug(f"Пропускаю (актуально): {output_format}/{output_path.name}")
+                successful += 1
+            else:
+                stale_formats.append(output_format)
+
+        if not stale_formats:
+            return successful
+
+        # Открываем изображение один раз на все форматы
+        with Image.open(image_path) as img:
+            # Конвертируем в RGB если нужно
+            if img.mode in ('RGBA', 'LA', 'P'):
+                # Сохраняем прозрачность для PNG
+                if img.mode == 'RGBA':
+                    img = img.convert('RGBA')
+                else:
+                    img = img.convert('RGB')
+
+            for output_format in stale_formats:
+                # Папка уже создана главным процессом в convert_all
+                output_filename = f"{image_path.stem}.{output_format}"
+                output_path = image_path.parent / output_format / output_filename
+
+                try:
+                    # Сохраняем в выбранном формате
+                    if output_format == 'webp':
+                        img.save(output_path, 'WEBP', quality=quality, method=method)
+                    elif output_format == 'avif':
+                        # При сбое внешнего кодировщика откатываемся на Pillow
+                        if avif_encoder != 'avifenc' or not _encode_avif_avifenc(img, output_path, quality, speed):
+                            img.save(output_path, 'AVIF', quality=quality, speed=speed)
+                    else:
+                        logger.error(f"Неподдерживаемый формат: {output_format}")
+                        continue
+
+                    logger.info(f"Конвертировано: {image_path.name} -> {output_format}/{output_filename}")
+                    successful += 1
+
+                except Exception as e:
+                    logger.error(f"Ошибка при конвертации {image_path.name} в {output_format}: {e}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при открытии {image_path.name}: {e}")
+
+    return successful
+
 class ImageConverter:
     """Класс для конвертации изображений"""
     
@@ -51,13 +166,16 @@ class ImageConverter:
             Список путей к изображениям
         """
         images = []
-        
-        for file_path in self.search_dir.rglob('*'):
-            if file_path.is_file() and file_path.suffix.lower() in self.SUPPORTED_INPUT_FORMATS:
-                # Пропускаем файлы, которые уже находятся в папках webp или avif
-                if 'webp' not in file_path.parts and 'avif' not in file_path.parts:
-                    images.append(file_path)
-        
+        exts = tuple(self.SUPPORTED_INPUT_FORMATS)
+
+        # Один os.walk вместо rglob('*'): папки webp/avif с готовыми
+        # копиями отсекаются на этапе спуска, а не фильтром по parts
+        for root, dirs, files in os.walk(self.search_dir):
+            dirs[:] = [d for d in dirs if d not in ('webp', 'avif')]
+            for name in files:
+                if name.lower().endswith(exts):
+                    images.append(Path(root) / name)
+
         logger.info(f"Найдено {len(images)} изображений для конвертации")
         return images
     
@@ -84,66 +202,47 @@ class ImageConverter:
         
         return webp_dir, avif_dir
     
-    def convert_image(self, image_path: Path, output_format: str, quality: int = 80) -> bool:
+    def convert_image(self, image_path: Path, output_format: str, quality: int = 80,
+                      method: int = 4, speed: int = 6, avif_encoder: str = 'pillow') -> bool:
         """
         Конвертирует одно изображение
-        
+
         Args:
             image_path: Путь к исходному изображению
             output_format: Формат для конвертации (webp или avif)
             quality: Качество сжатия (1-100)
-            
+            method: Усилие кодировщика webp (0-6, больше = медленнее/меньше файл)
+            speed: Скорость кодировщика avif (0-10, больше = быстрее)
+            avif_encoder: Кодировщик avif ('pillow' или 'avifenc')
+
         Returns:
             True если конвертация успешна, False иначе
         """
-        try:
-            # Создаем папки для выходных файлов
-            webp_dir, avif_dir = self.create_output_dirs(image_path)
-            
-            # Выбираем папку в зависимости от формата
-            output_dir = webp_dir if output_format == 'webp' else avif_dir
-            
-            # Открываем изображение
-            with Image.open(image_path) as img:
-                # Конвертируем в RGB если нужно
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    # Сохраняем прозрачность для PNG
-                    if img.mode == 'RGBA':
-                        img = img.convert('RGBA')
-                    else:
-                        img = img.convert('RGB')
-                
-                # Формируем имя выходного файла
-                output_filename = f"{image_path.stem}.{output_format}"
-                output_path = output_dir / output_filename
-                
-                # Сохраняем в выбранном формате
-                if output_format == 'webp':
-                    img.save(output_path, 'WEBP', quality=quality, method=6)
-                elif output_format == 'avif':
-                    img.save(output_path, 'AVIF', quality=quality)
-                else:
-                    logger.error(f"Неподдерживаемый формат: {output_format}")
-                    return False
-                
-                logger.info(f"Конвертировано: {image_path.name} -> {output_dir.name}/{output_filename}")
-                return True
-                
-        except Exception as e:
-            logger.error(f"Ошибка при конвертации {image_path.name}: {e}")
-            return False
+        # Создаем папки для выходных файлов
+        self.create_output_dirs(image_path)
+
+        return _convert_one((image_path, [output_format], quality, method, speed, avif_encoder)) == 1
     
-    def convert_all(self, output_formats: List[str] = None, quality: int = 80) -> Tuple[int, int]:
+    def convert_all(self, output_formats: List[str] = None, quality: int = 80,
+                    method: int = 4, speed: int = 6, avif_encoder: str = 'pillow') -> Tuple[int, int]:
         """
         Конвертирует все найденные изображения
-        
+
         Args:
             output_formats: Список форматов для конвертации (по умолчанию: webp и avif)
             quality: Качество сжатия
-            
+            method: Усилие кодировщика webp (0-6)
+            speed: Скорость кодировщика avif (0-10)
+            avif_encoder: Кодировщик avif ('pillow' или 'avifenc')
+
         Returns:
             Кортеж (успешные, общие)
         """
+        # Доступность внешнего кодировщика проверяем один раз,
+        # а не в каждом воркере на каждом изображении
+        if avif_encoder == 'avifenc' and shutil.which('avifenc') is None:
+            logger.warning("avifenc не найден в PATH — используем Pillow")
+            avif_encoder = 'pillow'
         if output_formats is None:
             output_formats = ['webp', 'avif']
         
@@ -152,18 +251,26 @@ class ImageConverter:
             logger.warning("Изображения для конвертации не найдены")
             return 0, 0
         
+        # Папки создаем заранее в главном процессе,
+        # чтобы не ловить гонки mkdir в воркерах
+        for image_path in images:
+            self.create_output_dirs(image_path)
+
+        # Одна задача на изображение (все форматы сразу):
+        # так исходник декодируется один раз, а не по разу на формат
+        tasks = [(image_path, output_formats, quality, method, speed, avif_encoder) for image_path in images]
+
         successful = 0
         total = len(images) * len(output_formats)
-        
+
         logger.info(f"Начинаю конвертацию {len(images)} изображений в форматы: {', '.join(output_formats)}")
-        
-        for i, image_path in enumerate(images, 1):
-            logger.info(f"Обрабатываю {i}/{len(images)}: {image_path.name}")
-            
-            for output_format in output_formats:
-                if self.convert_image(image_path, output_format, quality):
-                    successful += 1
-        
+
+        # Кодирование WebP и AVIF упирается в процессор, поэтому
+        # пул процессов: каждое ядро кодирует свою картинку независимо
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for converted in executor.map(_convert_one, tasks, chunksize=4):
+                successful += converted
+
         logger.info(f"Конвертация завершена: {successful}/{total} файлов")
         return successful, total
 
@@ -203,6 +310,32 @@ def main():
         help='Качество сжатия (по умолчанию: 80)'
     )
     
+    parser.add_argument(
+        '--method', '-m',
+        type=int,
+        default=4,
+        choices=range(0, 7),
+        metavar='[0-6]',
+        help='Усилие кодировщика webp: больше = медленнее, чуть меньше файл (по умолчанию: 4)'
+    )
+
+    parser.add_argument(
+        '--speed', '-s',
+        type=int,
+        default=6,
+        choices=range(0, 11),
+        metavar='[0-10]',
+        help='Скорость кодировщика avif: больше = быстрее (по умолчанию: 6)'
+    )
+
+    parser.add_argument(
+        '--avif-encoder',
+        choices=['pillow', 'avifenc'],
+        default='pillow',
+        help='Кодировщик avif: внешний avifenc обычно быстрее, '
+             'при его отсутствии используется Pillow (по умолчанию: pillow)'
+    )
+
     parser.add_argument(
         '--verbose', '-v',
         action='store_true',
@@ -225,7 +358,8 @@ def main():
         converter = ImageConverter(args.search_dir)
         
         # Запускаем конвертацию
-        successful, total = converter.convert_all(args.formats, args.quality)
+        successful, total = converter.convert_all(args.formats, args.quality, args.method,
+                                                  args.speed, args.avif_encoder)
         
         if successful == total:
             logger.info("✅ Все изображения успешно конвертированы!")